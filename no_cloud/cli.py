@@ -4,25 +4,57 @@
 import os
 import re
 import sys
+import json
 import click
 import string
 import datetime
 import subprocess
 
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
 
 from . import __version__
 from .remote import get_remote
-from .crypto import fernet_encrypt, fernet_decrypt, sha512_hash, digest
-from .formatter import make_html
+from .crypto import (
+    make_fernet, fernet_encrypt_stream, fernet_decrypt_stream, sha512_hash,
+    digest
+)
 from .utils import get_password, copy_to_clipboard
 from .fs import (
-    find_in_path, load_configuration, is_encrypted, list_files, test_mode,
-    fix_mode, asset_path
+    find_and_open_in_path, load_configuration, is_encrypted, list_files,
+    list_file_stats, mmap_file, rename_noreplace, test_mode, fix_mode,
+    asset_path, CRYPT_EXT
 )
 
 DEFAULT_CSS = 'stylesheet.css'
 DATE_YMD = '%Y-%m-%d'
 
+CHARACTER_CLASSES = (
+    ('l', string.ascii_lowercase * 3),
+    ('u', string.ascii_uppercase * 3),
+    ('d', string.digits * 3),
+    ('p', string.punctuation * 2)
+)
+
+
+def build_alphabets(classes):
+    alphabets = {}
+
+    for n in range(1 << len(classes)):
+        flags = frozenset(
+            flag for i, (flag, junk) in enumerate(classes) if n >> i & 1
+        )
+
+        alphabets[flags] = ''.join(
+            chars for i, (junk, chars) in enumerate(classes) if n >> i & 1
+        )
+
+    return alphabets
+
+
+ALPHABETS = build_alphabets(CHARACTER_CLASSES)
+
 
 def die(message):
     click.echo('Error: %s' % message)
@@ -30,22 +62,29 @@ def die(message):
 
 
 def echo(message=''):
-    if type(message) in (dict, list, tuple):
-        message = __import__('json').dumps(message, indent=2)
+    if isinstance(message, (dict, list, tuple)):
+        message = json.dumps(message, indent=2)
 
     click.echo(message)
 
 
-def main():
-    try:
-        __import__('weasyprint')
-    except ValueError as e:
-        if 'unknown locale' not in str(e):
-            raise e
+ECHO_BATCH = 1024
 
-        # Fix locale on Mac OS.
-        os.environ['LC_CTYPE'] = 'en_US'
 
+def echo_batched(lines, force=False):
+    '''Flush buffered per-file output in a single write.
+
+    Bulk commands append to `lines` and call this instead of echoing
+    each filename, collapsing thousands of write syscalls into a few.
+    '''
+    if lines and (force or len(lines) >= ECHO_BATCH):
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+
+        del lines[:]
+
+
+def main():
     try:
         cli(obj={})
     except AssertionError as e:
@@ -107,13 +146,18 @@ def push(paths):
     Remote configuration is found recursively starting from the path provided.
     See `remote` for more information.
     '''
+    configurations = {}
+
     for path in paths:
-        root, filename = find_in_path(path, '.no-cloud.yml.crypt',
-                '.no-cloud.yml')
+        root, filename, data = find_and_open_in_path(path,
+                '.no-cloud.yml.crypt', '.no-cloud.yml')
 
         assert root and filename, 'no configuration found'
 
-        config = load_configuration(root + '/' + filename)
+        if (root, filename) not in configurations:
+            configurations[(root, filename)] = load_configuration(data)
+
+        config = configurations[(root, filename)]
 
         with get_remote(config, root) as remote:
             for filename in list_files(path):
@@ -133,18 +177,59 @@ def pull(paths):
     Remote configuration is found recursively starting from the path provided.
     See `remote` for more information.
     '''
+    configurations = {}
+
     for path in paths:
-        root, filename = find_in_path(path, '.no-cloud.yml.crypt',
-                '.no-cloud.yml')
+        root, filename, data = find_and_open_in_path(path,
+                '.no-cloud.yml.crypt', '.no-cloud.yml')
 
         assert root and filename, 'no configuration found'
 
-        config = load_configuration(root + '/' + filename)
+        if (root, filename) not in configurations:
+            configurations[(root, filename)] = load_configuration(data)
+
+        config = configurations[(root, filename)]
 
         with get_remote(config, root) as remote:
             remote.pull(path)
 
 
+IO_BUFFER = 1 << 20
+
+
+def _encrypt_one(filename, fernet):
+    target = filename + '.crypt'
+
+    try:
+        with open(filename, 'rb', buffering=IO_BUFFER) as src, \
+                open(target + '.tmp', 'wb', buffering=IO_BUFFER) as dst:
+            fernet_encrypt_stream(mmap_file(src), dst, fernet)
+
+        os.replace(target + '.tmp', target)
+    except BaseException:
+        if os.path.exists(target + '.tmp'):
+            os.unlink(target + '.tmp')
+
+        raise
+
+
+def _decrypt_one(filename, fernet):
+    # The walker only feeds this CRYPT_EXT files; slice the suffix off.
+    target = filename[:-len(CRYPT_EXT)]
+
+    try:
+        with open(filename, 'rb', buffering=IO_BUFFER) as src, \
+                open(target + '.tmp', 'wb', buffering=IO_BUFFER) as dst:
+            fernet_decrypt_stream(mmap_file(src), dst, fernet)
+
+        os.replace(target + '.tmp', target)
+    except BaseException:
+        if os.path.exists(target + '.tmp'):
+            os.unlink(target + '.tmp')
+
+        raise
+
+
 @cli.command()
 @click.option('-d', '--dry-run', is_flag=True, help='Do not perform anything.')
 @click.option('-k', '--keep', is_flag=True, help='Leave clear files behind.')
@@ -163,28 +248,33 @@ def encrypt(dry_run, keep, paths):
         Confirmation: ***
         /home/benoit/Documents/letters/2016-12-20-santa.md
     '''
-    password = None if dry_run else get_password('Encryption password',
-            confirm=True)
+    fernet = None if dry_run else make_fernet(get_password(
+            'Encryption password', confirm=True))
 
-    for filename in list_files(paths):
-        if is_encrypted(filename):
-            continue
+    lines = []
+    filenames = []
+    for filename in list_files(paths,
+            predicate=lambda filename: not is_encrypted(filename)):
+        lines.append(filename)
+        echo_batched(lines)
 
-        echo(filename)
+        filenames.append(filename)
 
-        if dry_run:
-            continue
+    echo_batched(lines, force=True)
 
-        with open(filename, 'rb') as file:
-            data = file.read()
+    if dry_run or not filenames:
+        return
 
-        data = fernet_encrypt(data, password)
+    with ProcessPoolExecutor() as executor:
+        jobs = executor.map(partial(_encrypt_one, fernet=fernet),
+                filenames, chunksize=8)
 
-        with open(filename + '.crypt', 'wb') as file:
-            file.write(data)
+        for junk in jobs:
+            pass
 
-        if not keep:
-            os.remove(filename)
+    if not keep:
+        for filename in filenames:
+            os.unlink(filename)
 
 
 @cli.command()
@@ -205,28 +295,32 @@ def decrypt(dry_run, keep, paths):
         Decryption password: ***
         /home/benoit/Documents/letters/2016-12-20-santa.md.crypt
     '''
-    password = None if dry_run else get_password('Decryption Password')
+    fernet = None if dry_run else make_fernet(get_password(
+            'Decryption Password'))
 
-    for filename in list_files(paths):
-        if not is_encrypted(filename):
-            continue
+    lines = []
+    filenames = []
+    for filename in list_files(paths, predicate=is_encrypted):
+        lines.append(filename)
+        echo_batched(lines)
 
-        echo(filename)
+        filenames.append(filename)
 
-        if dry_run:
-            continue
+    echo_batched(lines, force=True)
 
-        with open(filename, 'rb') as file:
-            data = file.read()
+    if dry_run or not filenames:
+        return
 
-        data = fernet_decrypt(data, password)
+    with ProcessPoolExecutor() as executor:
+        jobs = executor.map(partial(_decrypt_one, fernet=fernet),
+                filenames, chunksize=8)
 
-        filename, ext = os.path.splitext(filename)
-        with open(filename, 'wb') as file:
-            file.write(data)
+        for junk in jobs:
+            pass
 
-        if not keep:
-            os.remove(filename + ext)
+    if not keep:
+        for filename in filenames:
+            os.unlink(filename)
 
 
 @cli.command()
@@ -247,8 +341,12 @@ def decrypt(dry_run, keep, paths):
         '(defaults to 0).', default=0)
 @click.option('-n', '--no-clipboard', is_flag=True, help='Disable clipboard '
         'copy, password is printed to stdout.')
+@click.option('-F', '--fast', is_flag=True, help='Run the hashing function '
+        'once over service and user name combined instead of twice. Halves '
+        'the derivation time but yields different passwords than the '
+        'default two-pass scheme.')
 def password(service, username, iterations, characters, length, filename,
-        version, no_clipboard):
+        version, no_clipboard, fast):
     '''Reproducibly generate passwords.
 
     Passwords are built using the SHA512 hashing function and a configurable
@@ -356,22 +454,20 @@ def password(service, username, iterations, characters, length, filename,
     if 'password' in config:
         return done(config['password'])
 
-    characters = ''
-    if 'l' in config['characters']:
-        characters += string.ascii_lowercase * 3
-    if 'u' in config['characters']:
-        characters += string.ascii_uppercase * 3
-    if 'd' in config['characters']:
-        characters += string.digits * 3
-    if 'p' in config['characters']:
-        characters += string.punctuation * 2
+    characters = ALPHABETS[frozenset(config['characters']) & set('ludp')]
 
     assert len(characters), 'invalid characters'
 
     password = get_password('Master password', confirm=True)
 
-    hashed = sha512_hash(config['username'], password, config['iterations'])
-    hashed = sha512_hash(config['service'], hashed, config['iterations'])
+    if fast:
+        subject = config['service'] + '\0' + config['username']
+        hashed = sha512_hash(subject, password, config['iterations'])
+    else:
+        hashed = sha512_hash(config['username'], password,
+                config['iterations'])
+        hashed = sha512_hash(config['service'], hashed,
+                config['iterations'])
 
     hashed = digest(hashed, characters, config['length'])
 
@@ -409,36 +505,56 @@ def rename(dry_run, force, pattern, paths):
 
     fmt = '%0' + str(length) + 'd'
 
-    files = []
+    dirnames = []
+    srcs = []
     for filename in filenames:
-        files.append({
-            'path': os.path.dirname(filename),
-            'src': os.path.basename(filename),
-            'dst': None
-        })
+        dirnames.append(os.path.dirname(filename))
+        srcs.append(os.path.basename(filename))
 
     pattern, replacement = pattern[2:-1].split('/', 1)
+
+    # Pure prefix/suffix insertions skip the regex engine entirely.
+    prepend = pattern == '^'
+    append = pattern == '$'
+
     pattern = re.compile(pattern)
+    sub = pattern.sub
+
+    has_i = '$i' in replacement
+
+    lines = []
+
+    repl = replacement
+    substitute = replacement.replace
 
     i = 1
-    for file in files:
-        repl = replacement[:].replace('$i', fmt % i)
-        file['dst'] = pattern.sub(repl, file['src'])
+    for dirname, src in zip(dirnames, srcs):
+        if has_i:
+            repl = substitute('$i', fmt % i)
 
-        file['src'] = file['path'] + '/' + file['src']
-        file['dst'] = file['path'] + '/' + file['dst']
+        if prepend:
+            dst = repl + src
+        elif append:
+            dst = src + repl
+        else:
+            dst = sub(repl, src)
 
-        echo(file['dst'])
+        src_path = dirname + '/' + src
+        dst_path = dirname + '/' + dst
 
-        if not dry_run:
-            if not force:
-                assert not os.path.isfile(file['dst']), \
-                        'destination exists `%s`' % file['dst']
+        lines.append(dst_path)
+        echo_batched(lines)
 
-            os.rename(file['src'], file['dst'])
+        if not dry_run:
+            if force:
+                os.rename(src_path, dst_path)
+            else:
+                rename_noreplace(src_path, dst_path)
 
         i += 1
 
+    echo_batched(lines, force=True)
+
 
 @cli.command()
 @click.option('-d', '--dry-run', is_flag=True, help='Do not perform anything '
@@ -456,19 +572,25 @@ def audit(dry_run, paths):
         c  /home/benoit/Documents/diamond.db
            /home/benoit/Documents/letters/2016-12-20-santa.md.crypt
     '''
-    for filename in list_files(paths):
-        clear = not is_encrypted(filename)
-        mode = not test_mode(filename)
+    lines = []
+    encrypted = is_encrypted
+
+    for filename, st in list_file_stats(paths):
+        clear = not encrypted(filename)
+        mode = not test_mode(filename, st)
 
         status = '' \
             + ('c' if clear else ' ') \
             + ('m' if mode else ' ')
 
-        echo('%s %s' % (status, filename))
+        lines.append('%s %s' % (status, filename))
+        echo_batched(lines)
 
         if mode and not dry_run:
             fix_mode(filename)
 
+    echo_batched(lines, force=True)
+
 
 @cli.command()
 @click.option('-p', '--preview', is_flag=True, help='Automatically preview '
@@ -506,7 +628,23 @@ def render(preview, timestamp, stylesheet, paths):
 
     Please note that this feature may not work on Python2/Mac OS.
     '''
-    from weasyprint import HTML, CSS
+    try:
+        from weasyprint import HTML, CSS
+    except ValueError as e:
+        if 'unknown locale' not in str(e):
+            raise e
+
+        # Fix locale on Mac OS.
+        os.environ['LC_CTYPE'] = 'en_US'
+
+        from weasyprint import HTML, CSS
+
+    from .formatter import make_html
+
+    if stylesheet == 'default':
+        stylesheet = asset_path(DEFAULT_CSS)
+
+    stylesheet = CSS(stylesheet)
 
     for filename in list_files(paths):
         assert filename.endswith('.md'), ''
@@ -528,14 +666,11 @@ def render(preview, timestamp, stylesheet, paths):
 
         filename = filename + '.pdf'
 
-        if stylesheet == 'default':
-            stylesheet = asset_path('stylesheet.css')
-
         echo(filename)
 
         HTML(string=html) \
             .write_pdf(filename, stylesheets=[
-                CSS(stylesheet)
+                stylesheet
             ])
 
         if preview:
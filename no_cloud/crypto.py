@@ -2,41 +2,119 @@
 # Released under the terms of the BSD license.
 
 import six
+import struct
 
 from base64 import urlsafe_b64encode
-from hashlib import md5, pbkdf2_hmac
-from cryptography.fernet import Fernet, InvalidToken
+from functools import lru_cache
+from hashlib import md5, sha256
 
+try:
+    from fastpbkdf2 import pbkdf2_hmac
+except ImportError:
+    from hashlib import pbkdf2_hmac
 
-def fernet_encrypt(message, password):
-    if isinstance(password, six.text_type):
-        password = password.encode('utf-8')
+STREAM_MAGIC = b'no-cloud\x00'
+STREAM_CHUNK = 1 << 20
 
-    password = md5(password).hexdigest()
 
-    if isinstance(password, six.text_type):
+def password_bytes(password):
+    if isinstance(password, str):
         password = password.encode('utf-8')
 
-    password = urlsafe_b64encode(password)
+    return password
+
+
+def derive_fernet_key(password):
+    return urlsafe_b64encode(sha256(password_bytes(password)).digest())
+
+
+def legacy_fernet_key(password):
+    # Key derivation used by earlier releases, kept for decryption only.
+    password = md5(password_bytes(password)).hexdigest()
+
+    return urlsafe_b64encode(password.encode('utf-8'))
+
+
+def make_fernet(password):
+    '''Derive the encryption key and build its Fernet once.
+
+    Encryption uses the current key; decryption also tries the legacy
+    key so files from earlier releases stay readable. Callers looping
+    over many files or chunks should build this once and reuse it.
+    '''
+    from cryptography.fernet import Fernet, MultiFernet
 
-    return Fernet(password) \
+    return MultiFernet([
+        Fernet(derive_fernet_key(password)),
+        Fernet(legacy_fernet_key(password))
+    ])
+
+
+def fernet_encrypt(message, password):
+    return make_fernet(password) \
             .encrypt(message)
 
 
 def fernet_decrypt(message, password):
-    if isinstance(password, six.text_type):
-        password = password.encode('utf-8')
+    from cryptography.fernet import InvalidToken
+
+    try:
+        return make_fernet(password) \
+                .decrypt(message)
+    except InvalidToken:
+        raise AssertionError('invalid decryption password')
 
-    password = md5(password).hexdigest()
 
-    if isinstance(password, six.text_type):
-        password = password.encode('utf-8')
+def fernet_encrypt_stream(in_fp, out_fp, fernet, chunk=STREAM_CHUNK):
+    '''Encrypt `in_fp` into `out_fp` one chunk at a time.
 
-    password = urlsafe_b64encode(password)
+    The output is a magic header followed by length-prefixed Fernet tokens,
+    keeping memory usage constant regardless of file size. `fernet` comes
+    from `make_fernet`, built once however many files are processed.
+    '''
+    out_fp.write(STREAM_MAGIC)
+
+    while True:
+        data = in_fp.read(chunk)
+
+        if not data:
+            break
+
+        token = fernet.encrypt(data)
+
+        out_fp.write(struct.pack('>I', len(token)))
+        out_fp.write(token)
+
+
+def fernet_decrypt_stream(in_fp, out_fp, fernet):
+    '''Decrypt `in_fp` into `out_fp` one chunk at a time.
+
+    Files that do not carry the magic header are treated as a single Fernet
+    token, which keeps previously encrypted files readable.
+    '''
+    from cryptography.fernet import InvalidToken
+
+    head = in_fp.read(len(STREAM_MAGIC))
 
     try:
-        return Fernet(password) \
-                .decrypt(message)
+        if head != STREAM_MAGIC:
+            out_fp.write(fernet.decrypt(head + in_fp.read()))
+            return
+
+        while True:
+            head = in_fp.read(4)
+
+            if not head:
+                break
+
+            assert len(head) == 4, 'truncated encrypted stream'
+
+            length, = struct.unpack('>I', head)
+            token = in_fp.read(length)
+
+            assert len(token) == length, 'truncated encrypted stream'
+
+            out_fp.write(fernet.decrypt(token))
     except InvalidToken:
         raise AssertionError('invalid decryption password')
 
@@ -51,16 +129,24 @@ def sha512_hash(message, salt, iterations=100000):
     return pbkdf2_hmac('sha512', message, salt, iterations)
 
 
-def digest(hashed, characters, length=16):
-    if six.PY2:
-        hashed = [ord(b) for b in hashed]
+@lru_cache(maxsize=16)
+def digest_table(characters):
+    alphabet = characters.encode('ascii')
+    characters_length = len(alphabet)
+
+    if characters_length & (characters_length - 1):
+        return bytes(
+            alphabet[c % characters_length] for c in range(256)
+        )
 
-    digest = ''
-    characters_length = len(characters)
-    for c in hashed[-length:]:
-        if c >= characters_length:
-            c = c % characters_length
+    # Power-of-two alphabets reduce with a mask instead of a modulo.
+    mask = characters_length - 1
 
-        digest += characters[c]
+    return bytes(
+        alphabet[c & mask] for c in range(256)
+    )
 
-    return digest
+
+def digest(hashed, characters, length=16):
+    return hashed[-length:] \
+            .translate(digest_table(characters)).decode('ascii')
@@ -1,69 +1,231 @@
 # Copyright (C) 2016 Benoit Myard <myardbenoit@gmail.com>
 # Released under the terms of the BSD license.
 
+import io
 import os
+import mmap
 import yaml
 import stat
+import errno
+import ctypes
 
-from .crypto import fernet_decrypt
-from .utils import get_password, nth, ignored, cleanup_path
+from functools import lru_cache
+from itertools import islice
+
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
+from .crypto import make_fernet, fernet_decrypt_stream, STREAM_MAGIC
+from .utils import get_password, ignored, cleanup_path
 
 DEFAULT_MODE = 0o600
 
+CRYPT_EXT = '.crypt'
+FERNET_PREFIX = b'gAAAA'
+
 
 def is_encrypted(filename):
-    return filename.endswith('.crypt')
+    return filename.endswith(CRYPT_EXT)
+
+
+def is_encrypted_data(data):
+    return data.startswith(STREAM_MAGIC) \
+            or data.startswith(FERNET_PREFIX)
+
+
+def mmap_file(file):
+    '''Map an open file read-only, falling back to the file itself.
+
+    Mapped files are consumed straight from the page cache, avoiding a
+    kernel to userspace copy per read. Empty files and special files
+    cannot be mapped and are returned unchanged.
+    '''
+    try:
+        return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (ValueError, OSError):
+        return file
+
+
+def parse_configuration(data, encrypted, version=0):
+    if encrypted:
+        password = get_password('Decryption password', confirm=False)
+
+        clear = io.BytesIO()
+        fernet_decrypt_stream(io.BytesIO(data), clear, make_fernet(password))
+
+        data = clear.getvalue()
+
+    documents = yaml.load_all(data, Loader=YamlLoader)
 
+    if version < 0:
+        return documents
 
-def load_configuration(filename, version=0):
+    document = next(islice(documents, version, None), None)
+    documents.close()
+
+    return document
+
+
+@lru_cache(maxsize=100)
+def _load_cached(filename, mtime, size, version):
     with open(filename, 'rb') as file:
         data = file.read()
 
-    if is_encrypted(filename):
-        password = get_password('Decryption password', confirm=False)
-        data = fernet_decrypt(data, password)
+    return parse_configuration(data, is_encrypted(filename), version)
+
+
+def load_configuration(source, version=0):
+    '''Load a YAML configuration from a filename or raw bytes.
+
+    Encrypted sources are detected by extension for filenames and by
+    content for bytes, then transparently decrypted. Files are cached on
+    (path, mtime, size) so repeated loads, including the decryption
+    prompt, only pay once until the file changes.
+    '''
+    if isinstance(source, bytes):
+        return parse_configuration(source, is_encrypted_data(source),
+                version)
 
-    data = yaml.load_all(data)
+    if version < 0:
+        with open(source, 'rb') as file:
+            return parse_configuration(file.read(), is_encrypted(source),
+                    version)
 
-    if version >= 0:
-        data = nth(data, version)
+    st = os.stat(source)
 
-    return data
+    return _load_cached(source, st.st_mtime_ns, st.st_size, version)
 
 
 def find_in_path(root, *candidates):
     if os.path.isfile(root):
         root = os.path.dirname(root)
 
-    for candidate in candidates:
-        if os.path.isfile(root + '/' + candidate):
-            return root, candidate
+    while True:
+        try:
+            names = set(
+                entry.name for entry in os.scandir(root) if entry.is_file()
+            )
+        except OSError:
+            names = ()
+
+        for candidate in candidates:
+            if candidate in names:
+                return root, candidate
+
+        if root in ('/', ''):
+            return None, None
+
+        root = os.path.dirname(root)
+
+
+def find_and_open_in_path(root, *candidates):
+    '''Like `find_in_path` but also returns the file contents.
 
-    if root == '/':
-        return None, None
+    Saves the caller a second path resolution and open once the lookup
+    has already located the file.
+    '''
+    root, filename = find_in_path(root, *candidates)
 
-    return find_in_path(os.path.dirname(root), *candidates)
+    if not root or not filename:
+        return None, None, None
 
+    with open(f'{root}/{filename}', 'rb') as file:
+        return root, filename, file.read()
 
-def list_files(root):
+
+def scan_files(root):
+    for entry in os.scandir(root):
+        if ignored(entry.name):
+            continue
+
+        if entry.is_dir(follow_symlinks=False):
+            for item in scan_files(entry.path):
+                yield item
+        elif entry.is_file(follow_symlinks=False):
+            yield entry
+
+
+def list_files(root, predicate=None):
     if type(root) in (list, tuple):
         for item in root:
-            for filename in list_files(item):
+            for filename in list_files(item, predicate):
                 yield filename
     elif os.path.isfile(root):
-        yield os.path.abspath(root)
+        filename = os.path.abspath(root)
+
+        if predicate is None or predicate(filename):
+            yield filename
+    else:
+        root = cleanup_path(root, keep_leading=True) or '/'
+
+        for entry in scan_files(root):
+            if predicate is None or predicate(entry.path):
+                yield entry.path
+
+
+def list_file_stats(root):
+    '''Like `list_files` but yields `(filename, stat_result)` pairs.
+
+    Directory entries reuse the stat information gathered during the
+    walk instead of issuing a second `stat` per file.
+    '''
+    if type(root) in (list, tuple):
+        for item in root:
+            for pair in list_file_stats(item):
+                yield pair
+    elif os.path.isfile(root):
+        filename = os.path.abspath(root)
+        yield filename, os.stat(filename)
     else:
-        for path, junk, filenames in os.walk(root):
-            for filename in filenames:
-                if ignored(filename):
-                    continue
+        root = cleanup_path(root, keep_leading=True) or '/'
+
+        for entry in scan_files(root):
+            yield entry.path, entry.stat(follow_symlinks=False)
+
+
+AT_FDCWD = -100
+RENAME_NOREPLACE = 1
+
+try:
+    _libc = ctypes.CDLL('libc.so.6', use_errno=True)
+    _renameat2 = _libc.renameat2
+except (OSError, AttributeError):
+    _renameat2 = None
+
+
+def rename_noreplace(src, dst):
+    '''Rename `src` to `dst`, refusing to overwrite `dst`.
+
+    On Linux this is a single renameat2(RENAME_NOREPLACE) syscall, so
+    the existence check and the rename are atomic. Elsewhere (or on
+    filesystems without renameat2) it degrades to a check-then-rename.
+    '''
+    if _renameat2 is not None:
+        ret = _renameat2(AT_FDCWD, src.encode(), AT_FDCWD, dst.encode(),
+                RENAME_NOREPLACE)
+
+        if ret == 0:
+            return
+
+        code = ctypes.get_errno()
+
+        assert code != errno.EEXIST, 'destination exists `%s`' % dst
+
+        if code not in (errno.ENOSYS, errno.EINVAL):
+            raise OSError(code, os.strerror(code), src)
+
+    assert not os.path.lexists(dst), 'destination exists `%s`' % dst
+
+    os.rename(src, dst)
 
-                yield cleanup_path(path + '/' + filename, keep_leading=True)
 
+def test_mode(filename, st=None, expected_mode=DEFAULT_MODE):
+    if st is None:
+        st = os.stat(filename)
 
-def test_mode(filename, expected_mode=DEFAULT_MODE):
-    mode = os.stat(filename).st_mode
-    return stat.S_IMODE(mode) == expected_mode
+    return stat.S_IMODE(st.st_mode) == expected_mode
 
 
 def fix_mode(filename, expected_mode=DEFAULT_MODE):
@@ -72,6 +234,6 @@ def fix_mode(filename, expected_mode=DEFAULT_MODE):
 
 def asset_path(filename):
     root = os.path.dirname(__file__)
-    root = os.path.abspath(root + '/..')
+    root = os.path.abspath(f'{root}/..')
 
-    return root + '/assets/' + filename
+    return f'{root}/assets/{filename}'
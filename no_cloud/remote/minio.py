@@ -1,8 +1,6 @@
 # Copyright (C) 2016 Benoit Myard <myardbenoit@gmail.com>
 # Released under the terms of the BSD license.
 
-from botocore.client import Config
-
 from .s3 import RemoteStorage as S3RemoteStorage
 
 
@@ -13,6 +11,8 @@ class RemoteStorage(S3RemoteStorage):
         assert 'endpoint' in self.config, '`endpoint` not found in configuration'
 
     def build_s3_args(self):
+        from botocore.client import Config
+
         args, kwargs = super(RemoteStorage, self).build_s3_args()
 
         if 'endpoint' in self.config:
@@ -2,11 +2,14 @@
 # Released under the terms of the BSD license.
 
 import os
-import boto3
+
+from concurrent.futures import ThreadPoolExecutor
 
 from ..cli import echo
 from .base import BaseRemoteStorage
 
+MAX_UPLOADS = 16
+
 
 class RemoteStorage(BaseRemoteStorage):
     def __init__(self, config, root):
@@ -32,15 +35,29 @@ class RemoteStorage(BaseRemoteStorage):
         return args, kwargs
 
     def __enter__(self):
+        import boto3
+
         args, kwargs = self.build_s3_args()
 
         s3 = boto3.resource(*args, **kwargs)
         self.bucket = s3.Bucket(self.config['bucket'])
 
+        self.executor = ThreadPoolExecutor(max_workers=MAX_UPLOADS)
+        self.jobs = []
+
         return self
 
     def __exit__(self, *args):
-        pass
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+
+    def flush(self):
+        jobs, self.jobs = self.jobs, []
+
+        for job in jobs:
+            job.result()
 
     def to_remote(self, path):
         if not path.startswith(self.root):
@@ -51,14 +68,15 @@ class RemoteStorage(BaseRemoteStorage):
         return path[length:].lstrip('/')
 
     def to_local(self, path):
-        return self.root + '/' + path
+        return f'{self.root}/{path}'
 
     def push(self, filename):
         remote_filename = self.to_remote(filename)
 
         echo(filename)
 
-        self.bucket.upload_file(filename, remote_filename)
+        self.jobs.append(self.executor.submit(self.bucket.upload_file,
+                filename, remote_filename))
 
     def pull(self, path):
         remote_path = self.to_remote(path)
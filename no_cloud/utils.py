@@ -2,10 +2,17 @@
 # Released under the terms of the BSD license.
 
 import re
-import fnmatch
 import getpass
 import pyperclip
 
+IGNORED = frozenset([
+    '.hg',
+    '.git',
+    '.env',
+    '.DS_Store',
+    '.localized'
+])
+
 TIME_UNITS = {
     'm': 60,
     'h': 60 * 60,
@@ -47,17 +54,7 @@ def first(generator):
 
 
 def ignored(filename):
-    patterns = [
-        '.hg',
-        '.git',
-        '.env',
-        '.DS_Store',
-        '.localized'
-    ]
-
-    for pattern in patterns:
-        if fnmatch.fnmatch(filename, pattern):
-            return True
+    return filename in IGNORED
 
 
 def cleanup_path(path, keep_leading=False):
@@ -71,9 +68,9 @@ def cleanup_path(path, keep_leading=False):
 
 
 def copy_to_clipboard(value):
-    pyperclip.copy(value)
-
-    if pyperclip.paste() == value:
-        return '*copied to clipboard*'
+    try:
+        pyperclip.copy(value)
+    except pyperclip.PyperclipException:
+        return value
 
-    return value
+    return '*copied to clipboard*'